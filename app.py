@@ -1,12 +1,12 @@
-from flask import Flask, render_template, redirect, url_for, request, flash
-from apscheduler.schedulers.background import BackgroundScheduler
-from apscheduler.jobstores.base import JobLookupError
+from flask import Flask, render_template, redirect, url_for, request, flash, Response
 from datetime import datetime, timedelta
 from tzlocal import get_localzone
-import RPi.GPIO as GPIO
-import sqlite3
+import profiling
+import outputs
+import backup
+import threading
 import atexit
-import pytz
+import time
 import os
 
 # Initialize the Flask application
@@ -14,30 +14,130 @@ app = Flask(__name__)
 
 app.secret_key = 'your_secret_key'
 
-# Configure the APScheduler
-scheduler = BackgroundScheduler()
-scheduler.start()
-
-# Initialize GPIO settings
-GPIO.setmode(GPIO.BCM)  # Use Broadcom pin numbering
+# APScheduler and RPi.GPIO are imported and initialized on first use, so importing
+# this module has no hardware or thread side effects
+scheduler = None
+GPIO = None
+
+# Set once create_app() has run the startup routines
+started = False
+
+# Current schema version, stored in the database as PRAGMA user_version
+SCHEMA_VERSION = 5
+
+# Values accepted by the log table and offered as filters in /log
+LOG_ORIGINS = ('manual', 'sched', 'timer', 'start', 'end')
+LOG_ACTIONS = ('plug_on', 'plug_off', 'server_on', 'server_off')
+
+# Indexes of the log table, by name
+LOG_INDEXES = {
+    'idx_log_date': 'date',
+    'idx_log_plug_date': 'plugID, date',
+    'idx_log_origin_date': 'origin, date',
+    'idx_log_action_date': 'action, date'
+}
+
+# Default settings, read from app.config so create_app() can override them
+app.config.from_mapping(
+    # Path to the SQLite database
+    DATABASE='piplug.db',
+    # Backup snapshots: directory, number kept and daily hour of the backup job
+    BACKUP_DIR='backups',
+    BACKUP_KEEP=7,
+    BACKUP_HOUR=3,
+    # Manual toggles within TOGGLE_DEBOUNCE seconds of each other are applied once, at most
+    # TOGGLE_MAX_WAIT seconds after the first of them, and an output is never switched
+    # sooner than RELAY_MIN_INTERVAL seconds after its last switch
+    TOGGLE_DEBOUNCE=0.5,
+    TOGGLE_MAX_WAIT=2.0,
+    RELAY_MIN_INTERVAL=1.0,
+    # Time allowed for create_app() before a slow startup warning is printed, in seconds
+    STARTUP_BUDGET=2.0
+)
+
+# Output drivers, created on first use and keyed by (kind, address)
+output_drivers = {}
+
+# Last switch time and switching lock of each output, keyed by (kind, address, channel)
+last_switched = {}
+output_locks = {}
+
+# Manual toggles waiting to be applied and the errors of failed ones, keyed by plugID
+pending_toggles = {}
+toggle_errors = {}
+toggle_lock = threading.Lock()
+
+# One lock per plug, held from reading a plug's state until its toggle is committed
+plug_locks = {}
+
+# Guards the first use of the scheduler, the GPIO and the outputs, which
+# may come from concurrent requests; reentrant because drivers set up the GPIO
+init_lock = threading.RLock()
+
+def get_scheduler():
+    """Return the APScheduler instance, starting it on first use."""
+    global scheduler
+    if scheduler is None:
+        with init_lock:
+            if scheduler is None:
+                from apscheduler.schedulers.background import BackgroundScheduler
+                background = BackgroundScheduler()
+                background.start()
+                scheduler = background
+                # Register the shutdown function with atexit to ensure it runs on server exit
+                atexit.register(shutdown_server)
+    return scheduler
+
+def remove_job(job_id):
+    """Remove a job from APScheduler; return False if it does not exist."""
+    from apscheduler.jobstores.base import JobLookupError
+    try:
+        get_scheduler().remove_job(job_id)
+        return True
+    except JobLookupError:
+        return False
 
-def initialize_database(num_devices, gpio_values):
-    conn = sqlite3.connect('piplug.db')
-    cursor = conn.cursor()
+def get_gpio():
+    """Return the RPi.GPIO module, setting it up on first use."""
+    global GPIO
+    if GPIO is None:
+        with init_lock:
+            if GPIO is None:
+                import RPi.GPIO
+                RPi.GPIO.setmode(RPi.GPIO.BCM)  # Use Broadcom pin numbering
+                GPIO = RPi.GPIO
+    return GPIO
+
+def connect_db():
+    """Open a connection to the database, traced by any running profile session."""
+    return profiling.connect(app.config['DATABASE'])
+
+def create_tables(cursor):
+    """Create the tables and indexes of the current schema version."""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS controller (
+            controllerID INTEGER PRIMARY KEY,
+            kind TEXT NOT NULL CHECK (length(kind) <= 10),
+            address INTEGER,
+            UNIQUE (kind, address)
+        )
+    ''')
 
-    # Create tables if they don't exist
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS plug (
-            plugID TEXT PRIMARY KEY CHECK (length(plugID) = 3),
+            plugID INTEGER PRIMARY KEY,
             name TEXT NOT NULL CHECK (length(name) <= 10),
-            gpio INTEGER NOT NULL CHECK (gpio BETWEEN 2 AND 26),
-            state BOOLEAN NOT NULL
+            controllerID INTEGER NOT NULL,
+            channel INTEGER NOT NULL CHECK (channel >= 0),
+            state BOOLEAN NOT NULL,
+            UNIQUE (controllerID, channel),
+            FOREIGN KEY (controllerID) REFERENCES controller(controllerID)
         )
     ''')
 
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS timer (
-            plugID TEXT PRIMARY KEY CHECK (length(plugID) = 3),
+            plugID INTEGER PRIMARY KEY,
             thour INTEGER NOT NULL CHECK (thour BETWEEN 0 AND 23),
             tminute INTEGER NOT NULL CHECK (tminute BETWEEN 0 AND 59),
             tnewState BOOLEAN NOT NULL,
@@ -49,7 +149,7 @@ def initialize_database(num_devices, gpio_values):
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS schedule (
             scheduleID INTEGER PRIMARY KEY AUTOINCREMENT,
-            plugID TEXT NOT NULL CHECK (length(plugID) = 3),
+            plugID INTEGER NOT NULL,
             shour INTEGER NOT NULL CHECK (shour BETWEEN 0 AND 23),
             sminute INTEGER NOT NULL CHECK (sminute BETWEEN 0 AND 59),
             srepeat TEXT CHECK (length(srepeat) <= 30),
@@ -58,68 +158,251 @@ def initialize_database(num_devices, gpio_values):
             FOREIGN KEY (plugID) REFERENCES plug(plugID)
         )
     ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_schedule_plug_active ON schedule (plugID, sactive)')
 
+    # Server start/end records have no plug, so plugID is NULL for them
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS log (
             logID INTEGER PRIMARY KEY AUTOINCREMENT,
-            date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            plugID TEXT NOT NULL CHECK (length(plugID) = 3),
+            date INTEGER NOT NULL DEFAULT (CAST(strftime('%s', 'now') AS INTEGER)),
+            plugID INTEGER,
             origin TEXT CHECK (origin IN ('manual', 'sched', 'timer', 'start', 'end')),
             action TEXT NOT NULL CHECK (length(action) <= 10),
+            count INTEGER NOT NULL DEFAULT 1 CHECK (count >= 1),
             FOREIGN KEY (plugID) REFERENCES plug(plugID)
         )
     ''')
-    
-    # Insert data into plug and timer tables based on user input
+    create_log_indexes(cursor)
+
+def initialize_database(num_devices, gpio_values):
+    # Convert GPIO values to integers and check for validity before the database is created
+    pins = outputs.NativeGPIO.channels
+    channels = []
     for i in range(num_devices):
-        plug_id = f'P{i+1:02}'  # Format as P01, P02, etc.
-        name = f'Plug {i+1}'
         gpio = gpio_values[i]
+        try:
+            channel = int(gpio)
+        except (TypeError, ValueError):
+            channel = None
+        if channel not in pins:
+            print(f"Invalid GPIO value for device {plug_label(i + 1)}")
+            raise ValueError(f"GPIO value for device {plug_label(i + 1)} must be between {pins[0]} and {pins[-1]}.")
+        channels.append(channel)
+
+    conn = connect_db()
+    cursor = conn.cursor()
 
-        # Convert GPIO value to integer and check for validity
-        if gpio is None or gpio == '':
-            print(f"Invalid GPIO value for device {plug_id}")
-            conn.close()
-            raise ValueError("GPIO value cannot be empty.")
+    # Create tables if they don't exist
+    create_tables(cursor)
+    cursor.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+
+    # The Raspberry Pi header is the first controller
+    cursor.execute("INSERT INTO controller (controllerID, kind, address) VALUES (1, 'gpio', NULL)")
 
-        cursor.execute('INSERT INTO plug (plugID, name, gpio, state) VALUES (?, ?, ?, ?)',
-                       (plug_id, name, int(gpio), False))
+    # Insert data into plug and timer tables based on user input
+    for i, channel in enumerate(channels):
+        plug_id = i + 1
+        name = f'Plug {i+1}'
+
+        cursor.execute('INSERT INTO plug (plugID, name, controllerID, channel, state) VALUES (?, ?, 1, ?, ?)',
+                       (plug_id, name, channel, False))
         cursor.execute('INSERT INTO timer (plugID, thour, tminute, tnewState, tactive) VALUES (?, 0, 0, 0, 0)',
                        (plug_id,))
 
     conn.commit()
     conn.close()
 
+def create_log_indexes(cursor):
+    """Create the composite indexes used by the filtered log queries."""
+    # logID is the rowid, so every index implicitly ends with it and can serve
+    # the (date, logID) ordering used for cursor pagination.
+    # Every filter has an index ending with date, so no filtered page is sorted in a
+    # temporary B-tree; combined filters use one of them and check the others per row.
+    for name, columns in LOG_INDEXES.items():
+        cursor.execute(f'CREATE INDEX IF NOT EXISTS {name} ON log ({columns})')
+
+def migrate_database():
+    """Upgrade an existing piplug.db to the current schema version."""
+    conn = connect_db()
+    conn.isolation_level = None  # Each migration step runs in its own explicit transaction
+    cursor = conn.cursor()
+    cursor.execute('PRAGMA user_version')
+    version = cursor.fetchone()[0]
+
+    try:
+        if version < 1:
+            # Convert log dates from CURRENT_TIMESTAMP text to integer epoch seconds
+            cursor.execute('BEGIN')
+            cursor.execute('''
+                CREATE TABLE log_new (
+                    logID INTEGER PRIMARY KEY AUTOINCREMENT,
+                    date INTEGER NOT NULL DEFAULT (CAST(strftime('%s', 'now') AS INTEGER)),
+                    plugID TEXT NOT NULL CHECK (length(plugID) = 3),
+                    origin TEXT CHECK (origin IN ('manual', 'sched', 'timer', 'start', 'end')),
+                    action TEXT NOT NULL CHECK (length(action) <= 10),
+                    FOREIGN KEY (plugID) REFERENCES plug(plugID)
+                )
+            ''')
+            cursor.execute('''
+                INSERT INTO log_new (logID, date, plugID, origin, action)
+                SELECT logID, COALESCE(CAST(strftime('%s', date) AS INTEGER), CAST(strftime('%s', 'now') AS INTEGER)),
+                       plugID, origin, action
+                FROM log
+            ''')
+            cursor.execute('DROP TABLE log')
+            cursor.execute('ALTER TABLE log_new RENAME TO log')
+            create_log_indexes(cursor)
+            cursor.execute('PRAGMA user_version = 1')
+            cursor.execute('COMMIT')
+            print("Log table migrated to integer timestamps.")
+
+        if version < 2:
+            # Replace the 'P01' text keys with integer keys and the gpio column with controller + channel
+            cursor.execute('BEGIN')
+            for table in ('plug', 'timer', 'schedule', 'log'):
+                cursor.execute(f'ALTER TABLE {table} RENAME TO {table}_old')
+            for index in LOG_INDEXES:
+                cursor.execute(f'DROP INDEX IF EXISTS {index}')
+            create_tables(cursor)
+
+            cursor.execute("INSERT INTO controller (controllerID, kind, address) VALUES (1, 'gpio', NULL)")
+            cursor.execute('''
+                INSERT INTO plug (plugID, name, controllerID, channel, state)
+                SELECT CAST(substr(plugID, 2) AS INTEGER), name, 1, gpio, state FROM plug_old
+            ''')
+            cursor.execute('''
+                INSERT INTO timer (plugID, thour, tminute, tnewState, tactive)
+                SELECT CAST(substr(plugID, 2) AS INTEGER), thour, tminute, tnewState, tactive FROM timer_old
+            ''')
+            cursor.execute('''
+                INSERT INTO schedule (scheduleID, plugID, shour, sminute, srepeat, snewStatus, sactive)
+                SELECT scheduleID, CAST(substr(plugID, 2) AS INTEGER), shour, sminute, srepeat, snewStatus, sactive
+                FROM schedule_old
+            ''')
+            cursor.execute('''
+                INSERT INTO log (logID, date, plugID, origin, action)
+                SELECT logID, date, CASE WHEN plugID GLOB 'P[0-9]*' THEN CAST(substr(plugID, 2) AS INTEGER) END,
+                       origin, action
+                FROM log_old
+            ''')
+
+            for table in ('log', 'schedule', 'timer', 'plug'):
+                cursor.execute(f'DROP TABLE {table}_old')
+            cursor.execute('PRAGMA user_version = 2')
+            cursor.execute('COMMIT')
+            print("Database migrated to integer plug keys.")
+
+        if version < 3:
+            # Number of coalesced toggles summarized by each log record
+            cursor.execute('BEGIN')
+            cursor.execute('PRAGMA table_info(log)')
+            if 'count' not in {column[1] for column in cursor.fetchall()}:
+                cursor.execute('ALTER TABLE log ADD COLUMN count INTEGER NOT NULL DEFAULT 1 CHECK (count >= 1)')
+            cursor.execute('PRAGMA user_version = 3')
+            cursor.execute('COMMIT')
+            print("Log table migrated to toggle counts.")
+
+        if version < 4:
+            # Indexes for the origin and action filters
+            cursor.execute('BEGIN')
+            create_log_indexes(cursor)
+            cursor.execute('PRAGMA user_version = 4')
+            cursor.execute('COMMIT')
+            print("Log indexes migrated to the filter combinations.")
+
+        if version < 5:
+            # Drop the multi-column filter indexes, which cost more log writes than they save reads
+            cursor.execute('BEGIN')
+            for index in ('idx_log_plug_origin_date', 'idx_log_plug_action_date',
+                          'idx_log_origin_action_date', 'idx_log_plug_origin_action_date'):
+                cursor.execute(f'DROP INDEX IF EXISTS {index}')
+            cursor.execute('PRAGMA user_version = 5')
+            cursor.execute('COMMIT')
+            print("Log indexes reduced to one per filter.")
+    except Exception:
+        if conn.in_transaction:
+            cursor.execute('ROLLBACK')
+        raise
+    finally:
+        conn.close()
+
+    # Reclaim the space of the rebuilt tables
+    if version < 2:
+        conn = connect_db()
+        conn.execute('VACUUM')
+        conn.close()
+
 def check_database():
     """Check if the database exists; if not, redirect to setup."""
-    if not os.path.exists('piplug.db'):
+    if not os.path.exists(app.config['DATABASE']):
         return False
     return True
 
+@app.template_filter('plug_label')
+def plug_label(plugID):
+    """Display label of a plug, e.g. P01; log records without a plug show as ---."""
+    return '---' if plugID is None else f'P{plugID:02}'
+
+def get_output_driver(kind, address):
+    """Return the driver of a controller, creating it on first use."""
+    key = (kind, address)
+    if key not in output_drivers:
+        with init_lock:
+            if key not in output_drivers:
+                output_drivers[key] = outputs.create_driver(kind, address, get_gpio)
+    return output_drivers[key]
+
+def set_output(kind, address, channel, state):
+    """Switch a controller channel on or off, no sooner than RELAY_MIN_INTERVAL after its last switch."""
+    key = (kind, address, channel)
+    with init_lock:
+        lock = output_locks.setdefault(key, threading.Lock())
+
+    # Every switching path goes through here, so schedules, timers and toggles all wait
+    with lock:
+        wait = last_switched.get(key, float('-inf')) + app.config['RELAY_MIN_INTERVAL'] - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+        get_output_driver(kind, address).output(channel, state)
+        last_switched[key] = time.monotonic()
+
+def get_plug_lock(plugID):
+    """Return the lock that serializes the manual toggles of a plug."""
+    with toggle_lock:
+        return plug_locks.setdefault(plugID, threading.Lock())
+
+def intended_state(plugID, state):
+    """State a plug will have once its pending toggles are applied."""
+    with toggle_lock:
+        pending = pending_toggles.get(plugID)
+    return pending['state'] if pending else state
+
 def initialize_timer_tactive():
     """Set all `tactive` values in the `timer` table to False."""
-    conn = sqlite3.connect('piplug.db')
+    conn = connect_db()
     cursor = conn.cursor()
     cursor.execute("UPDATE timer SET tactive = 0")
     conn.commit()
     conn.close()
 
-def setup_gpio_pins():
-    """Set all GPIO pins in the `plug` table as outputs and turn them off."""
-    conn = sqlite3.connect('piplug.db')
+def setup_outputs(restore_state=False):
+    """Set all plug outputs as outputs and turn them off, or back to their saved state."""
+    conn = connect_db()
     cursor = conn.cursor()
-    cursor.execute("SELECT gpio FROM plug")
-    gpios = cursor.fetchall()
-    for gpio in gpios:
-        gpio_pin = gpio[0]
-        GPIO.setup(gpio_pin, GPIO.OUT)
-        GPIO.output(gpio_pin, GPIO.LOW)  # Turn off initially
+    cursor.execute("SELECT kind, address, channel, state FROM plug JOIN controller ON plug.controllerID = controller.controllerID")
+    for kind, address, channel, state in cursor.fetchall():
+        # An unreachable expander must not keep the other outputs from starting
+        try:
+            get_output_driver(kind, address).setup(channel)
+            set_output(kind, address, channel, state if restore_state else False)  # Turn off initially
+        except Exception as e:
+            print(f"Error setting up {kind} output {channel}: {e}")
     conn.close()
 
 # Function to load active schedules from the database and schedule them
 def load_active_schedules():
     try:
-        conn = sqlite3.connect('piplug.db')
+        conn = connect_db()
         cursor = conn.cursor()
 
         # Retrieve all active schedules from the database
@@ -131,7 +414,7 @@ def load_active_schedules():
             schedule_id, plugID, shour, sminute, snewStatus, srepeat = schedule
 
             if srepeat:  # Create a recurring job based on specified days
-                scheduler.add_job(
+                get_scheduler().add_job(
                     id=f'schedule_{schedule_id}',
                     func=execute_schedule_action,
                     trigger='cron',
@@ -145,7 +428,7 @@ def load_active_schedules():
                 run_time = now.replace(hour=shour, minute=sminute, second=0, microsecond=0)
                 if run_time <= now:
                     run_time += timedelta(days=1)
-                scheduler.add_job(
+                get_scheduler().add_job(
                     id=f'schedule_{schedule_id}',
                     func=execute_schedule_action,
                     trigger='date',
@@ -158,28 +441,63 @@ def load_active_schedules():
     except Exception as e:
         print(f"Error loading active schedules: {e}")
 
+@profiling.profiled_job('backup')
+def run_backup():
+    try:
+        name = backup.create_backup(app.config['DATABASE'], app.config['BACKUP_DIR'], app.config['BACKUP_KEEP'], SCHEMA_VERSION)
+        print(f"Backup {name} created successfully.")
+    except Exception as e:
+        print(f"Error creating backup: {e}")
+
+def schedule_backups():
+    """Run the daily backup job in APScheduler."""
+    get_scheduler().add_job(
+        id='backup',
+        func=run_backup,
+        trigger='cron',
+        hour=app.config['BACKUP_HOUR'],
+        minute=0,
+        replace_existing=True
+    )
+
+def reload_after_restore():
+    """Bring the scheduler and outputs in line with a restored database."""
+    # Toggles queued before the restore must not overwrite the restored states
+    with toggle_lock:
+        pending_toggles.clear()
+    for job in get_scheduler().get_jobs():
+        if job.id.startswith(('schedule_', 'timer_', 'toggle_')):
+            remove_job(job.id)
+
+    migrate_database()
+    initialize_timer_tactive()
+    setup_outputs(restore_state=True)
+    load_active_schedules()
+
 # Function to deactivate all jobs in APScheduler when the server shuts down
 def shutdown_server():
     try:
         # Remove all active jobs from APScheduler
-        for job in scheduler.get_jobs():
-            scheduler.remove_job(job.id)
+        for job in get_scheduler().get_jobs():
+            remove_job(job.id)
         print("All active schedules have been deactivated.")
+
+        # Apply toggles still waiting for their debounce window; their jobs are gone, so
+        # none fires while set_output waits out the relay interval
+        for plugID in list(pending_toggles):
+            apply_toggle(plugID)
         log_server_end()
     except Exception as e:
         print(f"Error shutting down scheduler: {e}")
 
-# Register the shutdown function with atexit to ensure it runs on server exit
-atexit.register(shutdown_server)
-
 # Insert a record into the log table indicating the server startup
 def log_server_start():
     try:
-        conn = sqlite3.connect('piplug.db')
+        conn = connect_db()
         cursor = conn.cursor()
 
         # Inserir dados na tabela log
-        cursor.execute('INSERT INTO log (plugID, origin, action) VALUES (?, ?, ?)', ('---', 'start', 'server_on'))
+        cursor.execute('INSERT INTO log (plugID, origin, action) VALUES (?, ?, ?)', (None, 'start', 'server_on'))
         conn.commit()
         conn.close()
         print("Server startup log inserted successfully.")
@@ -189,11 +507,11 @@ def log_server_start():
 # Insert a record into the log table indicating the server ending
 def log_server_end():
     try:
-        conn = sqlite3.connect('piplug.db')
+        conn = connect_db()
         cursor = conn.cursor()
 
         # Inserir dados na tabela log
-        cursor.execute('INSERT INTO log (plugID, origin, action) VALUES (?, ?, ?)', ('---', 'end', 'server_off'))
+        cursor.execute('INSERT INTO log (plugID, origin, action) VALUES (?, ?, ?)', (None, 'end', 'server_off'))
         conn.commit()
         conn.close()
         print("Server ending log inserted successfully.")
@@ -207,48 +525,118 @@ def server_startup():
         app.config['STARTUP_REDIRECT'] = True
     else:
         print("Initializing system configurations...")
+        migrate_database()
         initialize_timer_tactive()
-        setup_gpio_pins()
+        setup_outputs()
         load_active_schedules()
+        schedule_backups()
         log_server_start()
         app.config['STARTUP_REDIRECT'] = False
 
-@app.route('/toggle_device/<plugID>')
+def create_app(config=None):
+    """Configure the application and run the startup routines.
+
+    `config` may override DATABASE, BACKUP_DIR, BACKUP_KEEP, BACKUP_HOUR,
+    TOGGLE_DEBOUNCE, TOGGLE_MAX_WAIT, RELAY_MIN_INTERVAL, STARTUP_BUDGET and any
+    Flask setting. Pass STARTUP=False to skip the startup routines, so nothing
+    touches the database, the scheduler or the GPIO until first use.
+
+    The application, its scheduler and its outputs are module-level singletons:
+    every call configures and returns the same `app`, so a later call with
+    another config also changes what earlier callers see. The startup routines
+    only run on the first call that does not skip them.
+    """
+    global started
+    start = time.perf_counter()
+
+    config = config or {}
+    app.config.update(config)
+
+    if config.get('STARTUP', True):
+        with init_lock:
+            if not started:
+                server_startup()
+                started = True
+
+    elapsed = time.perf_counter() - start
+    budget = app.config['STARTUP_BUDGET']
+    print(f"Startup completed in {elapsed:.2f} s.")
+    if elapsed > budget:
+        print(f"Warning: startup exceeded its budget of {budget:.2f} s.")
+    return app
+
+# Profile the request when asked through the header or the admin toggle
+@app.before_request
+def start_request_profile():
+    if request.endpoint in ('static', 'profiles', 'profile', 'download_profile'):
+        return
+    if request.headers.get(profiling.PROFILE_HEADER) or profiling.settings['requests']:
+        # A request is served unprofiled when the profiler cannot be enabled
+        try:
+            profiling.start_session('request', f'{request.method} {request.full_path.rstrip("?")}')
+        except Exception as e:
+            print(f"Error profiling request: {e}")
+
+@app.teardown_request
+def stop_request_profile(exception):
+    profiling.stop_session()
+
+# Report toggles that failed in the background on the next page load
+@app.before_request
+def flash_toggle_errors():
+    if request.endpoint == 'static':
+        return
+    with toggle_lock:
+        errors = list(toggle_errors.values())
+        toggle_errors.clear()
+    for error in errors:
+        flash(error, "error")
+
+@app.route('/toggle_device/<int:plugID>')
 def toggle_device(plugID):
     try:
         # Connect to database
-        conn = sqlite3.connect('piplug.db')
+        conn = connect_db()
         cursor = conn.cursor()
         
-        # Get device information
-        cursor.execute('SELECT gpio, state FROM plug WHERE plugID = ?', (plugID,))
-        device = cursor.fetchone()
-        
-        if not device:
-            flash(f"Device {plugID} not found.", "error")
-            return redirect(url_for('index'))
+        # A toggle being applied commits its state before this one reads it
+        with get_plug_lock(plugID):
+            # Get device information
+            cursor.execute('''
+                SELECT kind, address, channel, state FROM plug JOIN controller ON plug.controllerID = controller.controllerID
+                WHERE plugID = ?
+            ''', (plugID,))
+            device = cursor.fetchone()
+            
+            if not device:
+                flash(f"Device {plug_label(plugID)} not found.", "error")
+                return redirect(url_for('index'))
+            
+            kind, address, channel, current_state = device
+            
+            # Toggle the intended state, counting on toggles still waiting to be applied
+            with toggle_lock:
+                pending = pending_toggles.get(plugID)
+                new_state = not (pending['state'] if pending else current_state)
+                since = pending['since'] if pending else time.monotonic()
+                pending_toggles[plugID] = {'state': new_state, 'count': pending['count'] + 1 if pending else 1, 'since': since}
         
-        gpio_pin, current_state = device
-        
-        # Toggle the state (True -> False or False -> True)
-        new_state = not current_state
-        
-        # Update GPIO pin state
-        if new_state:
-            GPIO.output(gpio_pin, GPIO.HIGH)
+        # Apply once the burst settles, but never later than TOGGLE_MAX_WAIT after it started;
+        # set_output waits out the relay's minimum switching interval
+        delay = min(app.config['TOGGLE_DEBOUNCE'], since + app.config['TOGGLE_MAX_WAIT'] - time.monotonic())
+        if delay > 0:
+            get_scheduler().add_job(
+                id=f'toggle_{plugID}',
+                func=apply_toggle,
+                trigger='date',
+                run_date=datetime.now() + timedelta(seconds=delay),
+                args=[plugID],
+                replace_existing=True
+            )
         else:
-            GPIO.output(gpio_pin, GPIO.LOW)
+            apply_toggle(plugID)
         
-        # Update the state in the database
-        cursor.execute('UPDATE plug SET state = ? WHERE plugID = ?', (new_state, plugID))
-        conn.commit()
-        
-        # Insert a record into the log
-        action = "plug_on" if new_state else "plug_off"
-        cursor.execute('INSERT INTO log (plugID, origin, action) VALUES (?, ?, ?)', (plugID, 'manual', action))
-        conn.commit()
-        
-        flash(f"Device {plugID} has been {'turned on' if new_state else 'turned off'}.", "success")
+        flash(f"Device {plug_label(plugID)} will be {'turned on' if new_state else 'turned off'}.", "success")
         
     except Exception as e:
         flash(f"An error occurred: {e}", "error")
@@ -265,28 +653,77 @@ def index():
     if app.config.get('STARTUP_REDIRECT', False):
         return redirect(url_for('setup'))
     # Connect to the database
-    conn = sqlite3.connect('piplug.db')
+    conn = connect_db()
     cursor = conn.cursor()
     
     # Fetch data from the 'plug' table
     cursor.execute('SELECT plugID, name, state FROM plug')
     plugs = cursor.fetchall()
     
-    # Check if each device has an active schedule
-    plug_schedules = {}
-    for plug in plugs:
-        plugID = plug[0]
-        cursor.execute('SELECT sactive FROM schedule WHERE plugID = ? AND sactive = 1', (plugID,))
-        plug_schedules[plugID] = cursor.fetchone() is not None
+    # Check which devices have an active schedule
+    cursor.execute('SELECT DISTINCT plugID FROM schedule WHERE sactive = 1')
+    active = {row[0] for row in cursor.fetchall()}
+    plug_schedules = {plug[0]: plug[0] in active for plug in plugs}
+
+    # Show the state pending toggles will leave each plug in
+    plugs = [(plugID, name, intended_state(plugID, state)) for plugID, name, state in plugs]
 
     conn.close()
 
     return render_template('index.html', plugs=plugs, plug_schedules=plug_schedules, show_log_button=True)
 
+@app.route('/add_device', methods=['GET', 'POST'])
+def add_device():
+    kinds = list(outputs.DRIVERS)
+
+    if request.method == 'POST':
+        name = request.form['name']
+        kind = request.form['kind']
+        address = request.form.get('address', '').strip()
+        channel = request.form.get('channel', type=int)
+
+        conn = connect_db()
+        try:
+            # Native pins have no address, expanders are addressed by their I2C address (e.g. 0x20)
+            address = int(address, 0) if kind != 'gpio' else None
+            if kind not in outputs.DRIVERS or channel not in outputs.DRIVERS[kind].channels:
+                raise ValueError(f"Invalid channel for {kind}.")
+
+            cursor = conn.cursor()
+            cursor.execute('SELECT controllerID FROM controller WHERE kind = ? AND address IS ?', (kind, address))
+            controller = cursor.fetchone()
+            if controller:
+                controller_id = controller[0]
+            else:
+                cursor.execute('INSERT INTO controller (kind, address) VALUES (?, ?)', (kind, address))
+                controller_id = cursor.lastrowid
+
+            cursor.execute('INSERT INTO plug (name, controllerID, channel, state) VALUES (?, ?, ?, ?)',
+                           (name, controller_id, channel, False))
+            plugID = cursor.lastrowid
+            cursor.execute('INSERT INTO timer (plugID, thour, tminute, tnewState, tactive) VALUES (?, 0, 0, 0, 0)',
+                           (plugID,))
+
+            # Only keep the device once its output has been set up
+            get_output_driver(kind, address).setup(channel)
+            set_output(kind, address, channel, False)
+            conn.commit()
+
+            flash(f"Device {plug_label(plugID)} added successfully.", "success")
+            return redirect(url_for('device', plugID=plugID))
+        except Exception as e:
+            conn.rollback()
+            flash(f"An error occurred: {e}", "error")
+            return render_template('add_device.html', kinds=kinds, show_log_button=True)
+        finally:
+            conn.close()
+
+    return render_template('add_device.html', kinds=kinds, show_log_button=True)
+
 # Check if piplug.db exists and redirect to index if it does
 @app.route('/setup', methods=['GET', 'POST'])
 def setup():
-    if os.path.exists('piplug.db'):
+    if os.path.exists(app.config['DATABASE']):
         return redirect(url_for('index'))
 
     if request.method == 'POST':
@@ -301,7 +738,8 @@ def setup():
         try:
             # Initialize database and add records
             initialize_database(num_devices, gpio_values)
-            setup_gpio_pins()
+            setup_outputs()
+            schedule_backups()
             log_server_start()
             # Set startup redirect to False or remove this check after the first initialization
             app.config['STARTUP_REDIRECT'] = False
@@ -314,7 +752,7 @@ def setup():
 
 # Function to get device information
 def get_device_info(plugID):
-    conn = sqlite3.connect('piplug.db')
+    conn = connect_db()
     cursor = conn.cursor()
     cursor.execute('SELECT * FROM plug WHERE plugID = ?', (plugID,))
     plug_info = cursor.fetchone()
@@ -325,15 +763,18 @@ def get_device_info(plugID):
     conn.close()
     return plug_info, timer_info
 
-@app.route('/device/<plugID>')
+@app.route('/device/<int:plugID>')
 def device(plugID):
     try:
         # Connect to database
-        conn = sqlite3.connect('piplug.db')
+        conn = connect_db()
         cursor = conn.cursor()
 
         # Get device and timer data
-        cursor.execute('SELECT name, gpio, state FROM plug WHERE plugID = ?', (plugID,))
+        cursor.execute('''
+            SELECT name, kind, address, channel, state FROM plug JOIN controller ON plug.controllerID = controller.controllerID
+            WHERE plugID = ?
+        ''', (plugID,))
         plug = cursor.fetchone()
 
         cursor.execute('SELECT thour, tminute, tnewState, tactive FROM timer WHERE plugID = ?', (plugID,))
@@ -343,12 +784,13 @@ def device(plugID):
             flash("Device or timer data not found.", "error")
             return redirect(url_for('index'))
 
-        name, gpio, state = plug
+        name, kind, address, channel, state = plug
+        state = intended_state(plugID, state)
         thour, tminute, tnewState, tactive = timer_data
 
         # Check if the timer is active in APScheduler
         job_id = f"timer_{plugID}" 
-        job = scheduler.get_job(job_id)
+        job = get_scheduler().get_job(job_id)
         time_remaining = None
         if job:
             run_time = job.next_run_time
@@ -360,7 +802,9 @@ def device(plugID):
             'device.html',
             plugID=plugID,
             name=name,
-            gpio=gpio,
+            kind=kind,
+            address=address,
+            channel=channel,
             state=state,
             tnewState=tnewState,
             tactive=tactive,
@@ -373,11 +817,11 @@ def device(plugID):
         return redirect(url_for('index'))
 
 
-@app.route('/update_name/<plugID>', methods=['POST'])
+@app.route('/update_name/<int:plugID>', methods=['POST'])
 def update_name(plugID):
     new_name = request.form['newName']
 
-    conn = sqlite3.connect('piplug.db')
+    conn = connect_db()
     cursor = conn.cursor()
     cursor.execute('UPDATE plug SET name = ? WHERE plugID = ?', (new_name, plugID))
     conn.commit()
@@ -385,9 +829,9 @@ def update_name(plugID):
 
     return redirect(url_for('device', plugID=plugID))
 
-@app.route('/timer/<plugID>', methods=['GET', 'POST'])
+@app.route('/timer/<int:plugID>', methods=['GET', 'POST'])
 def timer(plugID):
-    conn = sqlite3.connect('piplug.db')
+    conn = connect_db()
     cursor = conn.cursor()
 
     # Fetch device and timer information
@@ -424,7 +868,7 @@ def timer(plugID):
         if tactive:
             # Add or update scheduling job
             run_time = datetime.now() + timedelta(hours=thour, minutes=tminute)
-            scheduler.add_job(
+            get_scheduler().add_job(
                 func=execute_timer_action,
                 id=job_id,
                 args=[plugID],
@@ -435,9 +879,7 @@ def timer(plugID):
             flash("Timer scheduled successfully.", "success")
         else:
             # Remove scheduling job if disabled
-            try:
-                scheduler.remove_job(job_id)
-            except JobLookupError:
+            if not remove_job(job_id):
                 flash("Timer job not found, but timer is now inactive.", "info")
 
         conn.close()
@@ -446,28 +888,75 @@ def timer(plugID):
     conn.close()
     return render_template('timer.html', plugID=plugID, name=name, thour=thour, tminute=tminute, tnewState=tnewState, tactive=tactive, show_log_button=True)
 
+@profiling.profiled_job('toggle_{0}')
+def apply_toggle(plugID):
+    """Apply the final state of a burst of manual toggles with a single log record."""
+    # Taps arriving meanwhile wait for the plug lock, so they see the committed state
+    with get_plug_lock(plugID):
+        with toggle_lock:
+            pending = pending_toggles.pop(plugID, None)
+        if not pending:
+            return
+
+        new_state = pending['state']
+        try:
+            conn = connect_db()
+            cursor = conn.cursor()
+
+            cursor.execute('''
+                SELECT kind, address, channel, state FROM plug JOIN controller ON plug.controllerID = controller.controllerID
+                WHERE plugID = ?
+            ''', (plugID,))
+            device = cursor.fetchone()
+
+            if not device:
+                print(f"Toggle: Device {plug_label(plugID)} not found.")
+                return
+
+            kind, address, channel, current_state = device
+
+            # Bursts that end where they started leave the relay alone
+            if new_state != current_state:
+                set_output(kind, address, channel, new_state)
+                cursor.execute('UPDATE plug SET state = ? WHERE plugID = ?', (new_state, plugID))
+
+            # Insert a single record into the log for the whole burst
+            action = "plug_on" if new_state else "plug_off"
+            cursor.execute('INSERT INTO log (plugID, origin, action, count) VALUES (?, ?, ?, ?)',
+                           (plugID, 'manual', action, pending['count']))
+            conn.commit()
+
+        except Exception as e:
+            print(f"An error occurred while toggling {plug_label(plugID)}: {e}")
+            with toggle_lock:
+                toggle_errors[plugID] = f"Device {plug_label(plugID)} could not be {'turned on' if new_state else 'turned off'}: {e}"
+        finally:
+            conn.close()
+
+@profiling.profiled_job('timer_{0}')
 def execute_timer_action(plugID):
     try:
-        conn = sqlite3.connect('piplug.db')
+        conn = connect_db()
         cursor = conn.cursor()
         
         # Get device and timer details
-        cursor.execute('SELECT gpio, tnewState FROM timer JOIN plug ON timer.plugID = plug.plugID WHERE timer.plugID = ?', (plugID,))
+        cursor.execute('''
+            SELECT kind, address, channel, tnewState FROM timer
+            JOIN plug ON timer.plugID = plug.plugID
+            JOIN controller ON plug.controllerID = controller.controllerID
+            WHERE timer.plugID = ?
+        ''', (plugID,))
         result = cursor.fetchone()
         
         if not result:
-            print(f"Timer action: Device {plugID} not found.")
+            print(f"Timer action: Device {plug_label(plugID)} not found.")
             return
         
-        gpio_pin, tnewState = result
+        kind, address, channel, tnewState = result
         
-        # Trigger GPIO
-        if tnewState:
-            GPIO.output(gpio_pin, GPIO.HIGH)
-            action = 'plug_on'
-        else:
-            GPIO.output(gpio_pin, GPIO.LOW)
-            action = 'plug_off'
+        # Trigger the output
+        set_output(kind, address, channel, tnewState)
+        action = 'plug_on' if tnewState else 'plug_off'
         
         # Update device status in database
         cursor.execute('UPDATE plug SET state = ? WHERE plugID = ?', (tnewState, plugID))
@@ -481,49 +970,122 @@ def execute_timer_action(plugID):
         cursor.execute('UPDATE timer SET tactive = 0 WHERE plugID = ?', (plugID,))
         conn.commit()
 
-        print(f"Timer action executed for device {plugID}: {'ON' if tnewState else 'OFF'}")
+        print(f"Timer action executed for device {plug_label(plugID)}: {'ON' if tnewState else 'OFF'}")
 
     except Exception as e:
         print(f"An error occurred during the timer action: {e}")
     finally:
         conn.close()
 
+def parse_log_filters(args):
+    """Build the WHERE clauses and parameters for the /log filters."""
+    filters = {
+        'plugID': args.get('plugID', '', type=int),
+        'origin': args.get('origin', ''),
+        'action': args.get('action', ''),
+        'date_from': args.get('date_from', ''),
+        'date_to': args.get('date_to', '')
+    }
+    clauses = []
+    params = []
+
+    if filters['plugID']:
+        clauses.append('plugID = ?')
+        params.append(filters['plugID'])
+    if filters['origin'] in LOG_ORIGINS:
+        clauses.append('origin = ?')
+        params.append(filters['origin'])
+    if filters['action'] in LOG_ACTIONS:
+        clauses.append('action = ?')
+        params.append(filters['action'])
+
+    # Date range is given in local days and compared as epoch seconds
+    if filters['date_from']:
+        day = datetime.strptime(filters['date_from'], '%Y-%m-%d').astimezone()
+        clauses.append('date >= ?')
+        params.append(int(day.timestamp()))
+    if filters['date_to']:
+        day = (datetime.strptime(filters['date_to'], '%Y-%m-%d') + timedelta(days=1)).astimezone()
+        clauses.append('date < ?')
+        params.append(int(day.timestamp()))
+
+    return filters, clauses, params
+
+def parse_log_cursor(value):
+    """Split a 'date:logID' pagination cursor into integers."""
+    try:
+        date, log_id = value.split(':')
+        return int(date), int(log_id)
+    except (AttributeError, ValueError):
+        return None
+
 @app.route('/log')
 def log():
     # Number of records per page
     per_page = 15
-    # Get current page number from URL parameters
-    page = request.args.get('page', 1, type=int)
-    offset = (page - 1) * per_page
 
-    # Connect to the database and fetch records with pagination
-    conn = sqlite3.connect('piplug.db')
-    cursor = conn.cursor()
-    cursor.execute('SELECT COUNT(*) FROM log')
-    total_logs = cursor.fetchone()[0]
+    try:
+        filters, clauses, params = parse_log_filters(request.args)
+    except ValueError:
+        flash("Invalid date range.", "error")
+        return redirect(url_for('log'))
+
+    # Cursor pagination: 'before' walks to older rows, 'after' to newer ones
+    before = parse_log_cursor(request.args.get('before'))
+    after = parse_log_cursor(request.args.get('after'))
+    if before:
+        clauses.append('(date, logID) < (?, ?)')
+        params.extend(before)
+        order = 'DESC'
+    elif after:
+        clauses.append('(date, logID) > (?, ?)')
+        params.extend(after)
+        order = 'ASC'
+    else:
+        order = 'DESC'
+
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ''
 
-    cursor.execute('SELECT date, plugID, origin, action FROM log ORDER BY date DESC LIMIT ? OFFSET ?', (per_page, offset))
+    # Connect to the database and fetch one extra record to detect another page
+    conn = connect_db()
+    cursor = conn.cursor()
+    cursor.execute(f'SELECT logID, date, plugID, origin, action, count FROM log {where} '
+                   f'ORDER BY date {order}, logID {order} LIMIT ?', (*params, per_page + 1))
     logs = cursor.fetchall()
+
+    cursor.execute('SELECT plugID FROM plug ORDER BY plugID')
+    plug_ids = [row[0] for row in cursor.fetchall()]
     conn.close()
 
+    has_more = len(logs) > per_page
+    logs = logs[:per_page]
+    if after:
+        logs.reverse()
+
+    # Rows beyond the page edge exist in the direction we came from whenever a cursor was used
+    has_newer = (has_more if after else bool(before)) and bool(logs)
+    has_older = (has_more if not after else True) and bool(logs)
+
     # Convert dates to system time zone
     local_tz = get_localzone()
     logs_converted = []
     for log in logs:
-        date, plug_id, origin, action = log
-        date_utc = datetime.strptime(date, '%Y-%m-%d %H:%M:%S').replace(tzinfo=pytz.utc)
-        date_local = date_utc.astimezone(local_tz).strftime('%Y-%m-%d %H:%M:%S')
-        logs_converted.append((date_local, plug_id, origin, action))
+        log_id, date, plug_id, origin, action, count = log
+        date_local = datetime.fromtimestamp(date, local_tz).strftime('%Y-%m-%d %H:%M:%S')
+        logs_converted.append((date_local, plug_id, origin, action, count))
 
-    # Calculate the total number of pages
-    total_pages = (total_logs // per_page) + (1 if total_logs % per_page > 0 else 0)
+    newer_cursor = f'{logs[0][1]}:{logs[0][0]}' if has_newer else None
+    older_cursor = f'{logs[-1][1]}:{logs[-1][0]}' if has_older else None
+    active_filters = {key: value for key, value in filters.items() if value}
 
-    return render_template('log.html', logs=logs_converted, page=page, total_pages=total_pages, show_log_button=False)
+    return render_template('log.html', logs=logs_converted, filters=filters, active_filters=active_filters,
+                           plug_ids=plug_ids, origins=LOG_ORIGINS, actions=LOG_ACTIONS,
+                           newer_cursor=newer_cursor, older_cursor=older_cursor, show_log_button=False)
 
 @app.route('/clear_log')
 def clear_log():
     try:
-        conn = sqlite3.connect('piplug.db')
+        conn = connect_db()
         cursor = conn.cursor()
         cursor.execute('DELETE FROM log')
         conn.commit()
@@ -533,9 +1095,9 @@ def clear_log():
         flash(f'Error clearing log: {e}', 'error')
     return redirect(url_for('index'))
 
-@app.route('/add_schedule/<plugID>', methods=['GET', 'POST'])
+@app.route('/add_schedule/<int:plugID>', methods=['GET', 'POST'])
 def add_schedule(plugID):
-    conn = sqlite3.connect('piplug.db')
+    conn = connect_db()
     cursor = conn.cursor()
 
     # Get data from the device to render the form
@@ -562,7 +1124,7 @@ def add_schedule(plugID):
         # Add task to APScheduler
         schedule_id = cursor.lastrowid
         if srepeat:
-            scheduler.add_job(
+            get_scheduler().add_job(
                 id=f'schedule_{schedule_id}',
                 func=execute_schedule_action,
                 trigger='cron',
@@ -576,7 +1138,7 @@ def add_schedule(plugID):
             run_time = now.replace(hour=shour, minute=sminute, second=0, microsecond=0)
             if run_time <= now:
                 run_time += timedelta(days=1)
-            scheduler.add_job(
+            get_scheduler().add_job(
                 id=f'schedule_{schedule_id}',
                 func=execute_schedule_action,
                 trigger='date',
@@ -590,25 +1152,26 @@ def add_schedule(plugID):
     conn.close()
     return render_template('add_schedule.html', plugID=plugID, name=name, show_log_button=True)
 
+@profiling.profiled_job('schedule_{2}')
 def execute_schedule_action(plugID, snewStatus, schedule_id):
     try:
-        conn = sqlite3.connect('piplug.db')
+        conn = connect_db()
         cursor = conn.cursor()
 
         # Update device status
         cursor.execute('UPDATE plug SET state = ? WHERE plugID = ?', (snewStatus, plugID))
         conn.commit()
 
-        # Trigger the device's GPIO
-        cursor.execute('SELECT gpio FROM plug WHERE plugID = ?', (plugID,))
-        gpio_pin = cursor.fetchone()
+        # Trigger the device's output
+        cursor.execute('''
+            SELECT kind, address, channel FROM plug JOIN controller ON plug.controllerID = controller.controllerID
+            WHERE plugID = ?
+        ''', (plugID,))
+        output = cursor.fetchone()
         
-        if gpio_pin:
-            gpio_pin = gpio_pin[0]          
-            if snewStatus:
-                GPIO.output(gpio_pin, GPIO.HIGH)  # Turn on the device
-            else:
-                GPIO.output(gpio_pin, GPIO.LOW)   # Turn off the device
+        if output:
+            kind, address, channel = output
+            set_output(kind, address, channel, snewStatus)
 
         # Insert record into log
         action = 'plug_on' if snewStatus else 'plug_off'
@@ -623,17 +1186,17 @@ def execute_schedule_action(plugID, snewStatus, schedule_id):
             # Disables scheduling and removes it from APScheduler if it is not recurring
             cursor.execute('UPDATE schedule SET sactive = ? WHERE scheduleID = ?', (False, schedule_id))
             conn.commit()
-            scheduler.remove_job(f'schedule_{schedule_id}')
+            get_scheduler().remove_job(f'schedule_{schedule_id}')
 
         conn.close()
 
     except Exception as e:
-        print(f"Error executing scheduled action for {plugID}: {e}")
+        print(f"Error executing scheduled action for {plug_label(plugID)}: {e}")
 
 
-@app.route('/schedules/<plugID>')
+@app.route('/schedules/<int:plugID>')
 def schedules(plugID):
-    conn = sqlite3.connect('piplug.db')
+    conn = connect_db()
     cursor = conn.cursor()
 
     # Get Device Name
@@ -666,7 +1229,7 @@ def schedules(plugID):
 
 @app.route('/toggle_schedule/<scheduleID>')
 def toggle_schedule(scheduleID):
-    conn = sqlite3.connect('piplug.db')
+    conn = connect_db()
     cursor = conn.cursor()
 
     # Check the current status of 'sactive'
@@ -686,7 +1249,7 @@ def toggle_schedule(scheduleID):
     if new_state:
         # Enable scheduling
         if srepeat:
-            scheduler.add_job(
+            get_scheduler().add_job(
                 id=f'schedule_{scheduleID}',
                 func=execute_schedule_action,
                 trigger='cron',
@@ -699,7 +1262,7 @@ def toggle_schedule(scheduleID):
             run_time = datetime.now().replace(hour=shour, minute=sminute, second=0, microsecond=0)
             if run_time <= datetime.now():
                 run_time += timedelta(days=1)
-            scheduler.add_job(
+            get_scheduler().add_job(
                 id=f'schedule_{scheduleID}',
                 func=execute_schedule_action,
                 trigger='date',
@@ -708,9 +1271,7 @@ def toggle_schedule(scheduleID):
             )
     else:
         # Disable scheduling
-        try:
-            scheduler.remove_job(f'schedule_{scheduleID}')
-        except JobLookupError:
+        if not remove_job(f'schedule_{scheduleID}'):
             print(f"Job schedule_{scheduleID} not found.")
 
     conn.close()
@@ -718,7 +1279,7 @@ def toggle_schedule(scheduleID):
 
 @app.route('/edit_schedule/<int:scheduleID>', methods=['GET', 'POST'])
 def edit_schedule(scheduleID):
-    conn = sqlite3.connect('piplug.db')
+    conn = connect_db()
     cursor = conn.cursor()
 
     # Get the scheduling data
@@ -752,13 +1313,10 @@ def edit_schedule(scheduleID):
         conn.commit()
 
         # Update the schedule in APScheduler
-        try:
-            scheduler.remove_job(f'schedule_{scheduleID}')
-        except JobLookupError:
-            pass  # If it doesn't exist, ignore it
+        remove_job(f'schedule_{scheduleID}')  # If it doesn't exist, ignore it
 
         if new_srepeat:
-            scheduler.add_job(
+            get_scheduler().add_job(
                 id=f'schedule_{scheduleID}',
                 func=execute_schedule_action,
                 trigger='cron',
@@ -771,7 +1329,7 @@ def edit_schedule(scheduleID):
             run_time = datetime.now().replace(hour=new_shour, minute=new_sminute, second=0, microsecond=0)
             if run_time <= datetime.now():
                 run_time += timedelta(days=1)
-            scheduler.add_job(
+            get_scheduler().add_job(
                 id=f'schedule_{scheduleID}',
                 func=execute_schedule_action,
                 trigger='date',
@@ -787,7 +1345,7 @@ def edit_schedule(scheduleID):
 
 @app.route('/delete_schedule/<int:scheduleID>', methods=['POST'])
 def delete_schedule(scheduleID):
-    conn = sqlite3.connect('piplug.db')
+    conn = connect_db()
     cursor = conn.cursor()
 
     # Get plugID to redirect correctly after deletion
@@ -801,10 +1359,7 @@ def delete_schedule(scheduleID):
         conn.commit()
 
         # Remove from APScheduler
-        try:
-            scheduler.remove_job(f'schedule_{scheduleID}')
-        except JobLookupError:
-            pass  # If it doesn't exist, ignore it
+        remove_job(f'schedule_{scheduleID}')  # If it doesn't exist, ignore it
 
         flash("Schedule deleted successfully.", "success")
         return redirect(url_for('schedules', plugID=plugID))
@@ -814,10 +1369,76 @@ def delete_schedule(scheduleID):
 
     conn.close()
 
+@app.route('/profiles', methods=['GET', 'POST'])
+def profiles():
+    if request.method == 'POST':
+        action = request.form.get('action')
+        if action == 'requests':
+            profiling.settings['requests'] = not profiling.settings['requests']
+            flash(f"Request profiling {'enabled' if profiling.settings['requests'] else 'disabled'}.", "success")
+        elif action == 'arm':
+            job_id = request.form.get('job_id', '').strip()
+            if get_scheduler().get_job(job_id):
+                profiling.armed_jobs.add(job_id)
+                flash(f"Job {job_id} will be profiled on its next run.", "success")
+            else:
+                flash(f"Job {job_id} not found.", "error")
+        elif action == 'clear':
+            profiling.profiles.clear()
+            flash("Profiles cleared.", "success")
+        return redirect(url_for('profiles'))
+
+    jobs = [job.id for job in get_scheduler().get_jobs()]
+    return render_template('profiles.html', profiles=profiling.profiles, jobs=jobs, armed_jobs=profiling.armed_jobs,
+                           profile_requests=profiling.settings['requests'], header=profiling.PROFILE_HEADER, show_log_button=True)
+
+@app.route('/profiles/<int:profileID>')
+def profile(profileID):
+    profile = profiling.get_profile(profileID)
+    if not profile:
+        flash("Profile not found.", "error")
+        return redirect(url_for('profiles'))
+    return render_template('profile.html', profile=profile, show_log_button=True)
+
+@app.route('/profiles/<int:profileID>.<fmt>')
+def download_profile(profileID, fmt):
+    profile = profiling.get_profile(profileID)
+    if not profile or fmt not in ('pstats', 'collapsed'):
+        flash("Profile not found.", "error")
+        return redirect(url_for('profiles'))
+
+    if fmt == 'pstats':
+        data, mimetype = profile['pstats'], 'application/octet-stream'
+    else:
+        data, mimetype = profiling.collapsed_stacks(profile), 'text/plain'
+    filename = f"piplug-profile-{profileID}.{fmt}"
+    return Response(data, mimetype=mimetype, headers={'Content-Disposition': f'attachment; filename={filename}'})
+
+@app.route('/backups', methods=['GET', 'POST'])
+def backups():
+    if request.method == 'POST':
+        if request.form.get('action') == 'restore':
+            name = request.form.get('name', '')
+            try:
+                backup.restore_backup(app.config['DATABASE'], app.config['BACKUP_DIR'], name, SCHEMA_VERSION)
+                reload_after_restore()
+                flash(f"Backup {name} restored successfully.", "success")
+            except Exception as e:
+                flash(f"Error restoring backup: {e}", "error")
+        else:
+            try:
+                name = backup.create_backup(app.config['DATABASE'], app.config['BACKUP_DIR'], app.config['BACKUP_KEEP'], SCHEMA_VERSION)
+                flash(f"Backup {name} created successfully.", "success")
+            except Exception as e:
+                flash(f"Error creating backup: {e}", "error")
+        return redirect(url_for('backups'))
+
+    return render_template('backups.html', backups=backup.list_backups(app.config['BACKUP_DIR']), show_log_button=True)
+
 
 if __name__ == '__main__':
     try:
-        server_startup()
-        app.run(host='0.0.0.0', port=5000, debug=False)
+        create_app().run(host='0.0.0.0', port=5000, debug=False)
     finally:
-        GPIO.cleanup()
+        if GPIO is not None:
+            GPIO.cleanup()
@@ -0,0 +1,121 @@
+"""Online backup and restore of the SQLite database.
+
+Snapshots are taken with SQLite's online backup API a few pages at a time, so
+the scheduler and the routes can keep writing while a backup runs. Each
+snapshot is checked with PRAGMA integrity_check and stored gzip-compressed;
+only the newest ones are kept.
+"""
+from datetime import datetime
+import tempfile
+import sqlite3
+import shutil
+import gzip
+import os
+
+# Pages copied per backup step and pause between steps, in seconds
+BACKUP_PAGES = 64
+BACKUP_SLEEP = 0.01
+
+# Tables a snapshot must contain to be restored, and those required from a schema version on
+REQUIRED_TABLES = {'plug', 'timer', 'schedule', 'log'}
+VERSION_TABLES = {2: {'controller'}}
+
+SNAPSHOT_PREFIX = 'piplug-'
+SNAPSHOT_SUFFIX = '.db.gz'
+
+
+def check_snapshot(path, schema_version):
+    """Raise ValueError unless the database at `path` can be restored."""
+    conn = sqlite3.connect(path)
+    try:
+        result = conn.execute('PRAGMA integrity_check').fetchone()[0]
+        if result != 'ok':
+            raise ValueError(f"Integrity check failed: {result}")
+
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        if version > schema_version:
+            raise ValueError(f"Schema version {version} is newer than this application ({schema_version}).")
+
+        required = REQUIRED_TABLES.union(*(tables for since, tables in VERSION_TABLES.items() if version >= since))
+        tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        missing = required - tables
+        if missing:
+            raise ValueError(f"Missing tables: {', '.join(sorted(missing))}")
+    finally:
+        conn.close()
+
+
+def create_backup(database, directory, keep, schema_version):
+    """Write a compressed, checked snapshot of `database` and rotate old ones."""
+    os.makedirs(directory, exist_ok=True)
+    name = f"{SNAPSHOT_PREFIX}{datetime.now():%Y%m%d-%H%M%S}{SNAPSHOT_SUFFIX}"
+    path = os.path.join(directory, name)
+
+    # Copy to an uncompressed file first so it can be checked before it is kept
+    fd, snapshot = tempfile.mkstemp(suffix='.db', dir=directory)
+    os.close(fd)
+    try:
+        source = sqlite3.connect(database)
+        target = sqlite3.connect(snapshot)
+        try:
+            source.backup(target, pages=BACKUP_PAGES, sleep=BACKUP_SLEEP)
+        finally:
+            target.close()
+            source.close()
+
+        check_snapshot(snapshot, schema_version)
+
+        with open(snapshot, 'rb') as src, gzip.open(path + '.tmp', 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+        os.replace(path + '.tmp', path)
+    finally:
+        os.remove(snapshot)
+        if os.path.exists(path + '.tmp'):
+            os.remove(path + '.tmp')
+
+    for old in list_backups(directory)[keep:]:
+        os.remove(os.path.join(directory, old['name']))
+
+    return name
+
+
+def list_backups(directory):
+    """Return the snapshots in `directory`, newest first."""
+    if not os.path.isdir(directory):
+        return []
+
+    backups = []
+    for name in os.listdir(directory):
+        if name.startswith(SNAPSHOT_PREFIX) and name.endswith(SNAPSHOT_SUFFIX):
+            stat = os.stat(os.path.join(directory, name))
+            backups.append({'name': name, 'size': stat.st_size, 'date': datetime.fromtimestamp(stat.st_mtime)})
+    return sorted(backups, key=lambda backup: backup['name'], reverse=True)
+
+
+def restore_backup(database, directory, name, schema_version):
+    """Validate a snapshot and copy it over the live database.
+
+    The snapshot is copied with the backup API into the live database, so
+    other connections see either the old or the restored contents.
+    """
+    if name not in {backup['name'] for backup in list_backups(directory)}:
+        raise ValueError(f"Backup {name} not found.")
+
+    fd, snapshot = tempfile.mkstemp(suffix='.db', dir=directory)
+    os.close(fd)
+    try:
+        with gzip.open(os.path.join(directory, name), 'rb') as src, open(snapshot, 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+
+        check_snapshot(snapshot, schema_version)
+
+        source = sqlite3.connect(snapshot)
+        target = sqlite3.connect(database)
+        try:
+            # A single step replaces the whole database in one write transaction
+            source.backup(target)
+        finally:
+            target.close()
+            source.close()
+    finally:
+        os.remove(snapshot)
@@ -0,0 +1,72 @@
+"""Output drivers for the controllers that plugs are wired to.
+
+Every plug is addressed as a controller plus a channel. The native controller
+drives the Raspberry Pi header pins directly, expander controllers drive relays
+behind an I2C port expander.
+"""
+import threading
+
+
+class NativeGPIO:
+    """Raspberry Pi header pins, the channel is the BCM pin number."""
+    channels = range(2, 27)
+
+    def __init__(self, address, get_gpio):
+        self.gpio = get_gpio()
+
+    def setup(self, channel):
+        self.gpio.setup(channel, self.gpio.OUT)
+
+    def output(self, channel, state):
+        self.gpio.output(channel, self.gpio.HIGH if state else self.gpio.LOW)
+
+
+class MCP23017:
+    """MCP23017 16-channel I2C expander, channels 0-7 on port A and 8-15 on port B."""
+    channels = range(16)
+
+    # IODIR and OLAT registers for ports A and B
+    IODIR = (0x00, 0x01)
+    OLAT = (0x14, 0x15)
+
+    def __init__(self, address, get_gpio, bus=1):
+        # smbus2 is only required when an expander is configured
+        from smbus2 import SMBus
+
+        self.bus = SMBus(bus)
+        self.address = address
+        self.latch = [0x00, 0x00]
+        self.lock = threading.Lock()
+
+        # Configure both ports as outputs, all channels off
+        for port in (0, 1):
+            self.bus.write_byte_data(self.address, self.OLAT[port], 0x00)
+            self.bus.write_byte_data(self.address, self.IODIR[port], 0x00)
+
+    def setup(self, channel):
+        pass
+
+    def output(self, channel, state):
+        port, bit = divmod(channel, 8)
+        with self.lock:
+            if state:
+                self.latch[port] |= 1 << bit
+            else:
+                self.latch[port] &= ~(1 << bit)
+            self.bus.write_byte_data(self.address, self.OLAT[port], self.latch[port])
+
+
+DRIVERS = {
+    'gpio': NativeGPIO,
+    'mcp23017': MCP23017
+}
+
+
+def create_driver(kind, address, get_gpio):
+    """Create the driver for a controller row.
+
+    `get_gpio` returns the RPi.GPIO module and is only called by drivers that use it.
+    """
+    if kind not in DRIVERS:
+        raise ValueError(f"Unknown controller type: {kind}")
+    return DRIVERS[kind](address, get_gpio)
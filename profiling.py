@@ -0,0 +1,232 @@
+"""On-demand profiling of Flask requests and APScheduler jobs.
+
+A profile session runs cProfile together with a stack sampler of the thread that
+started it and records that thread's SQL statements executed through `connect()`.
+Only one session runs at a time. The last
+MAX_PROFILES sessions are kept in memory and can be exported as pstats files or
+as collapsed stacks ready for flamegraph tools.
+"""
+from datetime import datetime
+import collections
+import functools
+import itertools
+import threading
+import sqlite3
+import time
+import sys
+import io
+import os
+
+# Number of profiles kept in memory
+MAX_PROFILES = 20
+
+# Interval between stack samples, in seconds
+SAMPLE_INTERVAL = 0.005
+
+# Request header that profiles a single request
+PROFILE_HEADER = 'X-PiPlug-Profile'
+
+# Admin toggles: profile every request and the job IDs armed for their next run
+settings = {'requests': False}
+armed_jobs = set()
+
+profiles = collections.deque(maxlen=MAX_PROFILES)
+
+_ids = itertools.count(1)
+_current = threading.local()
+
+# Held while a session runs: from Python 3.12 cProfile uses sys.monitoring, which
+# allows a single active profiler for the whole interpreter
+_active = threading.Lock()
+
+
+class StackSampler(threading.Thread):
+    """Periodically samples the stack of one thread into collapsed stack counts."""
+
+    def __init__(self, thread_id, interval=SAMPLE_INTERVAL):
+        super().__init__(daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{os.path.basename(code.co_filename)}:{code.co_name}')
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+class ProfileSession:
+    """Profiles the code run between start() and stop() on the current thread.
+
+    Up to Python 3.11 cProfile only sees the thread that enabled it; from 3.12 on
+    it also records whatever other threads run meanwhile. The stack samples and
+    SQL statements always belong to the current thread.
+    """
+
+    def __init__(self, kind, name):
+        # cProfile is only imported once something is actually profiled
+        import cProfile
+
+        self.kind = kind
+        self.name = name
+        self.sql = []
+        self.profiler = cProfile.Profile()
+        self.sampler = StackSampler(threading.get_ident())
+
+    def start(self):
+        self.started = datetime.now()
+        self.start_time = time.perf_counter()
+        # Fails if another profiler is active, before anything else is set up
+        self.profiler.enable()
+        try:
+            self.sampler.start()
+        except Exception:
+            self.profiler.disable()
+            raise
+        _current.session = self
+
+    def stop(self):
+        import marshal
+        import pstats
+
+        _current.session = None
+        self.profiler.disable()
+        duration = time.perf_counter() - self.start_time
+        self.sampler.stop()
+
+        summary = io.StringIO()
+        stats = pstats.Stats(self.profiler, stream=summary)
+        stats.sort_stats('cumulative').print_stats(25)
+
+        profiles.appendleft({
+            'id': next(_ids),
+            'kind': self.kind,
+            'name': self.name,
+            'started': self.started,
+            'duration': duration,
+            'summary': summary.getvalue(),
+            'pstats': marshal.dumps(stats.stats),
+            'stacks': self.sampler.stacks,
+            'sql': self.sql
+        })
+
+
+def start_session(kind, name):
+    """Start profiling the current thread unless a session is already running.
+
+    Returns True if a new session was started. Raises if the profiler cannot be
+    enabled, e.g. because a debugger or another profiling tool is active.
+    """
+    if not _active.acquire(blocking=False):
+        return False
+    try:
+        ProfileSession(kind, name).start()
+    except Exception:
+        _active.release()
+        raise
+    return True
+
+
+def stop_session():
+    """Stop the session running on the current thread, if any."""
+    session = getattr(_current, 'session', None)
+    if session is not None:
+        try:
+            session.stop()
+        finally:
+            _active.release()
+
+
+def get_profile(profile_id):
+    for profile in profiles:
+        if profile['id'] == profile_id:
+            return profile
+    return None
+
+
+def collapsed_stacks(profile):
+    """Return the sampled stacks in the 'frame;frame;frame count' format."""
+    return ''.join(f'{stack} {count}\n' for stack, count in profile['stacks'].most_common())
+
+
+def profiled_job(job_id_format):
+    """Profile a scheduler job function on its next run once its job ID is armed.
+
+    `job_id_format` builds the APScheduler job ID from the positional arguments,
+    e.g. 'schedule_{2}' or 'timer_{0}'.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            job_id = job_id_format.format(*args)
+            if job_id not in armed_jobs:
+                return func(*args, **kwargs)
+
+            # Profiling must never keep a job from running: on failure it runs
+            # unprofiled, and while another session is active it stays armed
+            try:
+                started = start_session('job', job_id)
+            except Exception as e:
+                print(f"Error profiling job {job_id}: {e}")
+                started = False
+            if started:
+                armed_jobs.discard(job_id)
+
+            try:
+                return func(*args, **kwargs)
+            finally:
+                if started:
+                    try:
+                        stop_session()
+                    except Exception as e:
+                        print(f"Error profiling job {job_id}: {e}")
+        return wrapper
+    return decorator
+
+
+class ProfiledCursor(sqlite3.Cursor):
+    """Cursor that times its statements while a profile session is running."""
+
+    def execute(self, sql, parameters=()):
+        session = getattr(_current, 'session', None)
+        if session is None:
+            return super().execute(sql, parameters)
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            session.sql.append((' '.join(sql.split()), time.perf_counter() - start))
+
+    def executemany(self, sql, seq_of_parameters):
+        session = getattr(_current, 'session', None)
+        if session is None:
+            return super().executemany(sql, seq_of_parameters)
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            session.sql.append((' '.join(sql.split()), time.perf_counter() - start))
+
+
+class ProfiledConnection(sqlite3.Connection):
+    def cursor(self, factory=ProfiledCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+
+def connect(database):
+    """Open a SQLite connection whose statements are recorded by profile sessions."""
+    return sqlite3.connect(database, factory=ProfiledConnection)
@@ -0,0 +1,212 @@
+"""Replay the configured schedules and timers against a virtual clock.
+
+Usage:
+    python simulate.py --days 7
+    python simulate.py --days 365 --start 2025-01-01T00:00 --timeline
+
+The simulation runs on a copy of piplug.db with simulated outputs, so the real
+database, scheduler and relays are never touched.
+"""
+from apscheduler.triggers.cron import CronTrigger
+from apscheduler.triggers.date import DateTrigger
+from apscheduler.jobstores.base import JobLookupError
+from datetime import datetime, timedelta
+from tzlocal import get_localzone
+import contextlib
+import argparse
+import tempfile
+import sqlite3
+import heapq
+import time
+import io
+import os
+
+import app
+
+
+class SimulatedOutputs:
+    """Stand-in for app.set_output that records writes against the virtual clock."""
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.states = {}
+        self.writes = []
+
+    def set_output(self, kind, address, channel, state):
+        self.states[(kind, address, channel)] = state
+        self.writes.append((self.clock.now, (kind, address, channel), state))
+
+
+class VirtualClock:
+    """Holds the current simulated time."""
+
+    def __init__(self, start):
+        self.now = start
+
+
+class VirtualScheduler:
+    """Minimal scheduler replacement that fires jobs from a heap of virtual times."""
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.queue = []
+        self.jobs = {}
+
+    def add_job(self, job_id, trigger, func, args):
+        self.jobs[job_id] = (trigger, func, args)
+        self._push(job_id, None)
+
+    def remove_job(self, job_id):
+        if job_id not in self.jobs:
+            raise JobLookupError(job_id)
+        del self.jobs[job_id]
+
+    def _push(self, job_id, previous):
+        trigger = self.jobs[job_id][0]
+        fire_time = trigger.get_next_fire_time(previous, self.clock.now)
+        if fire_time:
+            heapq.heappush(self.queue, (fire_time, job_id))
+
+    def run_until(self, end):
+        """Fire every job due before `end`, yielding each tick and its jobs."""
+        while self.queue and self.queue[0][0] < end:
+            fire_time = self.queue[0][0]
+            self.clock.now = fire_time
+            due = []
+            while self.queue and self.queue[0][0] == fire_time:
+                due.append(heapq.heappop(self.queue)[1])
+            yield fire_time, due
+
+
+def copy_database(source, target):
+    """Copy the live database with SQLite's backup API."""
+    src = sqlite3.connect(source)
+    dst = sqlite3.connect(target)
+    src.backup(dst)
+    src.close()
+    dst.close()
+
+
+def load_jobs(scheduler, start, tz):
+    """Queue the active schedules and timers stored in the database."""
+    conn = sqlite3.connect(app.app.config['DATABASE'])
+    cursor = conn.cursor()
+
+    cursor.execute('SELECT scheduleID, plugID, shour, sminute, snewStatus, srepeat FROM schedule WHERE sactive = ?', (True,))
+    for schedule_id, plugID, shour, sminute, snewStatus, srepeat in cursor.fetchall():
+        if srepeat:
+            trigger = CronTrigger(hour=shour, minute=sminute, day_of_week=srepeat, timezone=tz)
+        else:
+            run_time = start.replace(hour=shour, minute=sminute, second=0, microsecond=0)
+            if run_time <= start:
+                run_time += timedelta(days=1)
+            trigger = DateTrigger(run_date=run_time, timezone=tz)
+        scheduler.add_job(f'schedule_{schedule_id}', trigger, app.execute_schedule_action, [plugID, snewStatus, schedule_id])
+
+    # Active timers count down from the start of the simulation
+    cursor.execute('SELECT plugID, thour, tminute FROM timer WHERE tactive = ?', (True,))
+    for plugID, thour, tminute in cursor.fetchall():
+        trigger = DateTrigger(run_date=start + timedelta(hours=thour, minutes=tminute), timezone=tz)
+        scheduler.add_job(f'timer_{plugID}', trigger, app.execute_timer_action, [plugID])
+
+    cursor.execute('''
+        SELECT plugID, kind, address, channel FROM plug JOIN controller ON plug.controllerID = controller.controllerID
+    ''')
+    plugs = {(kind, address, channel): plugID for plugID, kind, address, channel in cursor.fetchall()}
+    conn.close()
+    return plugs
+
+
+def simulate(start, days):
+    """Run the simulation and return a dictionary with the results."""
+    tz = get_localzone()
+    start = start.replace(tzinfo=tz) if start.tzinfo is None else start
+    end = start + timedelta(days=days)
+
+    clock = VirtualClock(start)
+    outputs = SimulatedOutputs(clock)
+    scheduler = VirtualScheduler(clock)
+
+    config = app.app.config
+    originals = (config['DATABASE'], app.set_output, app.scheduler)
+    workdir = tempfile.mkdtemp(prefix='piplug-sim-')
+    sim_db = os.path.join(workdir, 'piplug.db')
+    copy_database(config['DATABASE'], sim_db)
+
+    ticks = []
+    output = io.StringIO()
+    try:
+        config['DATABASE'], app.set_output, app.scheduler = sim_db, outputs.set_output, scheduler
+        with contextlib.redirect_stdout(output):
+            app.migrate_database()
+        plugs = load_jobs(scheduler, start, tz)
+
+        with contextlib.redirect_stdout(output):
+            for fire_time, due in scheduler.run_until(end):
+                tick_start = time.perf_counter()
+                for job_id in due:
+                    if job_id not in scheduler.jobs:
+                        continue
+                    _, func, args = scheduler.jobs[job_id]
+                    func(*args)
+                    if job_id in scheduler.jobs:
+                        scheduler._push(job_id, fire_time)
+                ticks.append((fire_time, len(due), time.perf_counter() - tick_start))
+    finally:
+        config['DATABASE'], app.set_output, app.scheduler = originals
+        os.remove(sim_db)
+        os.rmdir(workdir)
+
+    # Group output writes into a timeline per plug
+    timelines = {}
+    for when, key, state in outputs.writes:
+        timelines.setdefault(plugs.get(key), []).append((when, bool(state)))
+
+    errors = [line for line in output.getvalue().splitlines() if 'error' in line.lower()]
+
+    return {
+        'start': start,
+        'end': end,
+        'ticks': ticks,
+        'actions': sum(len(timeline) for timeline in timelines.values()),
+        'timelines': timelines,
+        'errors': errors
+    }
+
+
+def print_report(result, show_timeline):
+    ticks = result['ticks']
+    costs = [cost for _, _, cost in ticks]
+
+    print(f"Simulated {result['start']:%Y-%m-%d %H:%M} to {result['end']:%Y-%m-%d %H:%M}")
+    print(f"Ticks: {len(ticks)}, jobs fired: {sum(jobs for _, jobs, _ in ticks)}, actions: {result['actions']}")
+    if costs:
+        costs.sort()
+        print(f"Tick cost: total {sum(costs) * 1000:.1f} ms, "
+              f"mean {sum(costs) / len(costs) * 1000:.3f} ms, "
+              f"p95 {costs[min(len(costs) - 1, int(len(costs) * 0.95))] * 1000:.3f} ms, "
+              f"max {costs[-1] * 1000:.3f} ms")
+
+    for plugID, timeline in sorted(result['timelines'].items(), key=lambda item: item[0] or 0):
+        on_count = sum(1 for _, state in timeline if state)
+        print(f"{app.plug_label(plugID)}: {len(timeline)} actions ({on_count} on, {len(timeline) - on_count} off)")
+        if show_timeline:
+            for when, state in timeline:
+                print(f"    {when:%Y-%m-%d %H:%M} {'ON' if state else 'OFF'}")
+
+    for error in result['errors']:
+        print(f"Error: {error}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay PiPlug schedules and timers on a virtual clock.')
+    parser.add_argument('--days', type=float, default=7, help='length of the simulation in days')
+    parser.add_argument('--start', type=datetime.fromisoformat, default=None, help='start time (ISO format), defaults to now')
+    parser.add_argument('--timeline', action='store_true', help='print every action per plug')
+    args = parser.parse_args()
+
+    if not app.check_database():
+        parser.error(f"Database {app.app.config['DATABASE']} not found, run the setup first.")
+
+    result = simulate(args.start or datetime.now(), args.days)
+    print_report(result, args.timeline)